@@ -39,56 +39,116 @@ Usage Instructions:
 Environment Variables:
 -------------------
 - HF_TOKEN: Your Hugging Face API token (optional - users can provide their own)
+- TOKEN_HASH_KEY: Optional secret mixed into the token hashes shown in logs
+- PNG_COMPRESS_LEVEL: zlib level (0-9) for PNG encoding (default: 1, fast and still lossless)
 """
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from huggingface_hub import InferenceClient
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from dotenv import load_dotenv
 import os
-import base64
+import asyncio
+import pybase64
 import io
 import logging
 import hashlib
-from typing import Optional
-from PIL import Image
+import re
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    # Only needed for annotations; images arrive from huggingface_hub already
+    # opened, so /health and cold starts never pay for the PIL import
+    from PIL import Image
 
 # Load environment variables
 load_dotenv()
 
 # Setup logging with privacy filters
+# Patterns that look like HF tokens, compiled once rather than per log record
+_HF_TOKEN_RE = re.compile(r'hf_[A-Za-z0-9]{10,}', re.IGNORECASE)
+
+def _redact(text: str) -> str:
+    """Replace token-like substrings, skipping the regex when no token prefix is present"""
+    # Plain substring checks are far cheaper than a regex scan, and most
+    # log lines contain no token at all. Every case variant of the 'hf_'
+    # prefix contains 'f_' or 'F_', so this never skips a possible match
+    if 'f_' not in text and 'F_' not in text:
+        return text
+    return _HF_TOKEN_RE.sub('[REDACTED]', text)
+
 class PrivacyFilter(logging.Filter):
     """Filter to prevent sensitive data from appearing in logs"""
     def filter(self, record):
         # Redact any HF tokens that might appear in logs
         if hasattr(record, 'msg'):
-            msg = str(record.msg)
-            # Redact patterns that look like HF tokens
-            if 'hf_' in msg.lower():
-                record.msg = msg.replace(msg[msg.lower().find('hf_'):msg.lower().find('hf_')+20], '[REDACTED]')
+            msg = record.msg if isinstance(record.msg, str) else str(record.msg)
+            redacted = _redact(msg)
+            if redacted is not msg:
+                record.msg = redacted
+        # %-style arguments are merged into the message later, redact them too
+        if isinstance(record.args, tuple):
+            record.args = tuple(
+                _redact(arg) if isinstance(arg, str) else arg
+                for arg in record.args
+            )
+        elif isinstance(record.args, dict):
+            # Mapping-style args, e.g. logger.info("%(token)s", {"token": ...})
+            record.args = {
+                key: _redact(value) if isinstance(value, str) else value
+                for key, value in record.args.items()
+            }
         return True
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.addFilter(PrivacyFilter())
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Mount static directory
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# Landing page is served from memory; the ETag lets browsers revalidate with a 304
+with open("static/index.html", "rb") as f:
+    INDEX_HTML = f.read()
+INDEX_ETAG = '"' + hashlib.blake2b(INDEX_HTML, digest_size=8).hexdigest() + '"'
+
 # Model configuration
 MODEL_ID = "black-forest-labs/FLUX.1-schnell"  # Keep original model ID
 DEFAULT_TOKEN = os.environ.get("HF_TOKEN")
+# Fast deflate keeps PNGs lossless at a fraction of the optimize=True encode cost
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", "1"))
+if not 0 <= PNG_COMPRESS_LEVEL <= 9:
+    # Fail at startup rather than on every re-encoded PNG
+    raise ValueError(f"PNG_COMPRESS_LEVEL must be between 0 and 9, got {PNG_COMPRESS_LEVEL}")
+# Secret key for token hashes in logs (BLAKE2b accepts at most 64 bytes)
+TOKEN_HASH_KEY = os.environ.get("TOKEN_HASH_KEY", "").encode()[:64]
+# Largest valid /generate-image body: ASCII-escaping clients send a character
+# outside the BMP (e.g. an emoji) as a 12-byte surrogate pair that counts once
+# toward max_length, so a 1000-char prompt can take 12000 bytes plus the
+# other fields
+MAX_BODY_BYTES = 16384
+_HF_TOKEN_SHAPE_RE = re.compile(r'hf_[A-Za-z0-9]{30,}')
 
 class ImageRequest(BaseModel):
     prompt: str = Field(..., min_length=1, max_length=1000)
     width: int = Field(default=1024, ge=256, le=2048)
     height: int = Field(default=768, ge=256, le=2048)
     return_format: Optional[str] = Field(default="base64", pattern="^(base64|raw)$")
+    image_format: str = Field(default="png", pattern="^(png|webp|jpeg)$")
     hf_token: Optional[str] = None
+    # Bypass the provider's response cache to force a fresh generation
+    no_cache: bool = False
+    
+    @field_validator('width', 'height')
+    @classmethod
+    def round_to_multiple_of_8(cls, v: int) -> int:
+        # The model expects multiples of 8; rounding down keeps v >= 256
+        return v & ~7
     
     class Config:
         # Ensure tokens are never included in any Pydantic representations
@@ -96,23 +156,239 @@ class ImageRequest(BaseModel):
             str: lambda v: '[REDACTED]' if v and 'hf_' in v.lower() else v
         }
 
+def verify_token_shape(req: ImageRequest) -> ImageRequest:
+    """Reject malformed tokens before any network I/O"""
+    if req.hf_token and not _HF_TOKEN_SHAPE_RE.fullmatch(req.hf_token):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid HF token format. Tokens start with 'hf_' followed by letters and digits."
+        )
+    return req
+
 def get_token_hash(token: Optional[str]) -> str:
     """Create a secure hash of token for identification without exposing it"""
     if not token:
         return "default"
-    # Use SHA256 hash for secure, one-way identification
-    return hashlib.sha256(token.encode()).hexdigest()[:8]
-
-def create_client(token: Optional[str] = None) -> InferenceClient:
-    """Create InferenceClient without caching to protect user privacy"""
-    api_key = token or DEFAULT_TOKEN
-    if not api_key:
-        raise ValueError("No HF token available")
+    # BLAKE2b with a 4-byte digest yields the 8 hex chars directly; the
+    # optional key stops hashes being correlated across deployments
+    return hashlib.blake2b(token.encode(), digest_size=4, key=TOKEN_HASH_KEY).hexdigest()
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def _source_png_bytes(image: "Image.Image") -> Optional[bytes]:
+    """Return the provider's original PNG bytes if the image was never decoded
+
+    huggingface_hub hands back a lazily opened Image over the response bytes,
+    so a PNG from the provider can be passed through without a decode and
+    re-encode round-trip.
+    """
+    fp = getattr(image, "fp", None)
+    if image.format != "PNG" or not isinstance(fp, io.BytesIO):
+        return None
+    raw = fp.getvalue()
+    return raw if raw.startswith(PNG_SIGNATURE) else None
+
+# Output formats: PIL format name, media type and encoder options
+IMAGE_FORMATS: Dict[str, Tuple[str, str, Dict[str, Any]]] = {
+    "png": ("PNG", "image/png", {"compress_level": PNG_COMPRESS_LEVEL}),
+    "webp": ("WEBP", "image/webp", {"quality": 90, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 92, "optimize": False, "progressive": False}),
+}
+
+def _save_image(image: "Image.Image", fp, image_format: str):
+    """Encode `image` into `fp` in one of IMAGE_FORMATS (blocking)"""
+    pil_format, _, options = IMAGE_FORMATS[image_format]
+    if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+        # JPEG has no alpha or palette support
+        image = image.convert("RGB")
+    image.save(fp, format=pil_format, **options)
+
+# The base64 alphabet needs no JSON escaping, so the response body can be
+# assembled from raw bytes without building an intermediate str
+_B64_JSON_PREFIX = b'{"image_base64":"'
+_B64_JSON_SUFFIX = b'"}'
+
+class _Base64Writer:
+    """Write-only file object that base64-encodes encoder output as it arrives"""
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self._pending = b""
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast("B")
+        size = len(view)
+        if self._pending:
+            # Complete the carried-over group from the head of this write
+            # rather than copying the whole block behind the leftover bytes
+            need = 3 - len(self._pending)
+            head = self._pending + bytes(view[:need])
+            view = view[need:]
+            if len(head) < 3:
+                self._pending = head
+                return size
+            self.chunks.append(pybase64.b64encode(head))
+        # Encode whole 3-byte groups now; carry the remainder to the next write
+        cut = len(view) - len(view) % 3
+        if cut:
+            self.chunks.append(pybase64.b64encode(view[:cut]))
+        self._pending = bytes(view[cut:])
+        return size
+
+    def flush(self):
+        pass
+
+    def finish(self) -> List[bytes]:
+        if self._pending:
+            self.chunks.append(pybase64.b64encode(self._pending))
+            self._pending = b""
+        return self.chunks
+
+def _base64_json(chunks: List[bytes]) -> bytes:
+    """Join base64 chunks into the {"image_base64": ...} body in a single copy"""
+    return b"".join([_B64_JSON_PREFIX, *chunks, _B64_JSON_SUFFIX])
+
+def _encode_base64_json(image: "Image.Image", image_format: str) -> bytes:
+    """Encode, base64 and wrap an image as JSON in one pass (blocking)"""
+    writer = _Base64Writer()
+    _save_image(image, writer, image_format)
+    return _base64_json(writer.finish())
+
+def _cache_headers(use_cache: bool) -> Dict[str, str]:
+    """Headers asking the provider to serve (or skip) cached results for repeat prompts"""
+    return {"X-use-cache": "true" if use_cache else "false"}
+
+_STREAM_END = object()
+# Encoded chunks buffered ahead of a slow client before the encoder waits
+_STREAM_QUEUE_CHUNKS = 8
+
+class _QueueWriter:
+    """Write-only file object that hands PIL encoder output to an asyncio queue"""
+    def __init__(self, chunks: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+        self.chunks = chunks
+        self.loop = loop
+        self.cancelled = False
+
+    def put(self, item):
+        # Runs on the encoder thread: waits only this worker while the bounded
+        # queue is full, never the event loop or the consumer
+        asyncio.run_coroutine_threadsafe(self.chunks.put(item), self.loop).result()
+
+    def write(self, data) -> int:
+        if self.cancelled:
+            # Client went away, abort the encode
+            raise OSError("Image stream cancelled")
+        self.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+async def _stream_image(image: "Image.Image", image_format: str) -> AsyncIterator[bytes]:
+    """Yield encoded bytes as the encoder produces them (encode runs in a thread)"""
+    chunks: asyncio.Queue = asyncio.Queue(maxsize=_STREAM_QUEUE_CHUNKS)
+    writer = _QueueWriter(chunks, asyncio.get_running_loop())
+
+    def encode():
+        try:
+            _save_image(image, writer, image_format)
+        finally:
+            writer.put(_STREAM_END)
+
+    encoder = asyncio.create_task(asyncio.to_thread(encode))
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is _STREAM_END:
+                break
+            yield chunk
+        # Surface encoder errors
+        await encoder
+    except Exception as e:
+        # Headers are already sent, so the handler's error logging never sees this
+        logger.error("Image stream failed: %s - %s", type(e).__name__, e)
+        raise
+    finally:
+        writer.cancelled = True
+        # Free the queue so an encoder blocked on a full queue wakes up, sees
+        # the cancel on its next write and finishes with room left for the end marker
+        while not chunks.empty():
+            chunks.get_nowait()
+        # On early close the aborted encode's error is expected; retrieve it
+        encoder.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+@lru_cache(maxsize=2)
+def _default_client(use_cache: bool = True) -> InferenceClient:
+    """Process-wide client for the server's own token (never a user token)"""
+    return InferenceClient(
+        provider="nebius",
+        api_key=DEFAULT_TOKEN,
+        headers=_cache_headers(use_cache)
+    )
+
+def create_client(token: Optional[str] = None, use_cache: bool = True) -> InferenceClient:
+    """Create InferenceClient; user tokens are never cached to protect privacy"""
+    # InferenceClient has nothing to close: huggingface_hub's per-thread
+    # requests sessions own the sockets, and a one-shot client is released
+    # as soon as the handler returns
+    if not token:
+        if not DEFAULT_TOKEN:
+            raise ValueError("No HF token available")
+        return _default_client(use_cache)
     return InferenceClient(
         provider="nebius",
-        api_key=api_key
+        api_key=token,
+        headers=_cache_headers(use_cache)
     )
 
+def _map_hf_error(error_msg: str) -> Tuple[int, str]:
+    """Map a lower-cased inference error message to an HTTP status and user-facing detail"""
+    if any(x in error_msg for x in ["token", "unauthorized", "authentication"]):
+        return 401, "Invalid HF token. Check your token or try providing your own."
+    if "timeout" in error_msg:
+        return 504, "Request timed out. Try a simpler prompt or smaller dimensions."
+    if "rate limit" in error_msg:
+        return 429, "Rate limit exceeded. Try again later or use your own HF token."
+    return 500, "Image generation failed. Please try again."
+
+async def _encode_response(image: "Image.Image", raw: bool, image_format: str = "png") -> Response:
+    """Build the raw image or base64 JSON response for a generated image"""
+    _, media_type, _ = IMAGE_FORMATS[image_format]
+    # Pass the provider's PNG through as-is; only re-encode other formats
+    img_bytes = _source_png_bytes(image) if image_format == "png" else None
+    
+    # The provider may render at a different size than requested; report
+    # what was actually returned instead of resampling to the target
+    resolution_header = {"X-Image-Actual-Resolution": f"{image.width}x{image.height}"}
+    
+    if raw:
+        headers = {
+            **resolution_header,
+            "Content-Disposition": f"attachment; filename=generated-image.{image_format}",
+            # Privacy headers
+            "Cache-Control": "no-store, no-cache, must-revalidate, private",
+            "Pragma": "no-cache",
+            "Expires": "0"
+        }
+        if img_bytes is None:
+            # Decode the lazily opened provider image now, while errors can
+            # still become a 500; once streaming starts the 200 is committed
+            await asyncio.to_thread(image.load)
+            # Stream the encoder output so the first bytes go out before
+            # the whole image exists in memory
+            return StreamingResponse(
+                _stream_image(image, image_format),
+                media_type=media_type,
+                headers=headers
+            )
+        return Response(content=img_bytes, media_type=media_type, headers=headers)
+    
+    if img_bytes is None:
+        body = await asyncio.to_thread(_encode_base64_json, image, image_format)
+    else:
+        image_base64 = await asyncio.to_thread(pybase64.b64encode, img_bytes)
+        body = _base64_json([image_base64])
+    return Response(content=body, media_type="application/json", headers=resolution_header)
+
 @app.get("/")
 async def read_root(request: Request):
     if "curl" in request.headers.get("user-agent", "").lower():
@@ -125,7 +401,16 @@ async def read_root(request: Request):
             },
             "example": 'curl -X POST "http://localhost:8000/generate-image" -H "Content-Type: application/json" -d "{\\"prompt\\": \\"a cat\\"}" --output image.png'
         }
-    return FileResponse("static/index.html")
+    cache_headers = {
+        "ETag": INDEX_ETAG,
+        "Cache-Control": "public, max-age=300"
+    }
+    # If-None-Match uses weak comparison: ignore W/ prefixes and honour "*"
+    if_none_match = request.headers.get("if-none-match", "")
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    if "*" in tags or INDEX_ETAG in tags:
+        return Response(status_code=304, headers=cache_headers)
+    return Response(content=INDEX_HTML, media_type="text/html", headers=cache_headers)
 
 @app.get("/health")
 async def health_check():
@@ -137,14 +422,14 @@ async def health_check():
     }
 
 @app.post("/generate-image")
-async def generate_image(req: ImageRequest, http_request: Request):
+async def generate_image(http_request: Request, req: ImageRequest = Depends(verify_token_shape)):
     # Create token hash for logging (privacy-safe)
     token_hash = get_token_hash(req.hf_token)
     
     try:
-        # Create client (not cached to prevent token exposure)
+        # Create client (user tokens are not cached to prevent token exposure)
         try:
-            client = create_client(req.hf_token)
+            client = create_client(req.hf_token, use_cache=not req.no_cache)
         except ValueError:
             raise HTTPException(
                 status_code=401,
@@ -153,67 +438,40 @@ async def generate_image(req: ImageRequest, http_request: Request):
         
         # Log only truncated prompt and token hash (never full prompt or token)
         prompt_preview = req.prompt[:50] + "..." if len(req.prompt) > 50 else req.prompt
-        logger.info(f"Request [token:{token_hash}]: '{prompt_preview}' ({req.width}x{req.height})")
+        # %-style args defer formatting until a handler emits the record, and
+        # go through PrivacyFilter's record.args redaction
+        logger.info("Request [token:%s]: '%s' (%dx%d)", token_hash, prompt_preview, req.width, req.height)
         
-        # Ensure dimensions are multiples of 8
-        width = (req.width // 8) * 8
-        height = (req.height // 8) * 8
+        # Dimensions are already rounded to multiples of 8 by ImageRequest
+        width, height = req.width, req.height
         
         try:
-            # Generate image
-            image = client.text_to_image(
+            # Generate image (blocking HTTP call, keep it off the event loop)
+            image = await asyncio.to_thread(
+                client.text_to_image,
                 prompt=req.prompt,
                 model=MODEL_ID,
                 width=width,
                 height=height
             )
-            logger.info(f"Success [token:{token_hash}]")
+            logger.info("Success [token:%s]", token_hash)
             
         except Exception as e:
             error_msg = str(e).lower()
             
             # Map error to appropriate HTTP status
-            if any(x in error_msg for x in ["token", "unauthorized", "authentication"]):
-                status_code, detail = 401, "Invalid HF token. Check your token or try providing your own."
-            elif "timeout" in error_msg:
-                status_code, detail = 504, "Request timed out. Try a simpler prompt or smaller dimensions."
-            elif "rate limit" in error_msg:
-                status_code, detail = 429, "Rate limit exceeded. Try again later or use your own HF token."
-            else:
-                status_code = 500
+            status_code, detail = _map_hf_error(error_msg)
+            if status_code == 500:
                 # Log the actual error for debugging
-                logger.error(f"Error details [token:{token_hash}]: {error_msg}")
-                detail = "Image generation failed. Please try again."
+                logger.error("Error details [token:%s]: %s", token_hash, error_msg)
             
-            logger.error(f"Error [token:{token_hash}]: {status_code} - {detail}")
+            logger.error("Error [token:%s]: %d - %s", token_hash, status_code, detail)
             raise HTTPException(status_code=status_code, detail=detail)
         
-        # Convert to bytes
-        img_bytes = io.BytesIO()
-        image.save(img_bytes, format='PNG', optimize=True)
-        img_bytes = img_bytes.getvalue()
-        
-        # Clear client reference immediately to allow garbage collection
-        del client
-        
         # Return based on format
         is_curl = "curl" in http_request.headers.get("user-agent", "").lower()
-        if req.return_format == "raw" or (is_curl and req.return_format != "base64"):
-            return Response(
-                content=img_bytes,
-                media_type="image/png",
-                headers={
-                    "Content-Disposition": "attachment; filename=generated-image.png",
-                    # Privacy headers
-                    "Cache-Control": "no-store, no-cache, must-revalidate, private",
-                    "Pragma": "no-cache",
-                    "Expires": "0"
-                }
-            )
-        
-        return {
-            "image_base64": base64.b64encode(img_bytes).decode("utf-8")
-        }
+        raw = req.return_format == "raw" or (is_curl and req.return_format != "base64")
+        return await _encode_response(image, raw, req.image_format)
         
     except HTTPException:
         raise
@@ -222,12 +480,49 @@ async def generate_image(req: ImageRequest, http_request: Request):
         error_type = type(e).__name__
         error_msg = str(e)
         if "token" not in error_msg.lower():
-            logger.error(f"Unexpected error [token:{token_hash}]: {error_type} - {error_msg}")
+            logger.error("Unexpected error [token:%s]: %s - %s", token_hash, error_type, error_msg)
         else:
-            logger.error(f"Unexpected error [token:{token_hash}]: {error_type}")
+            logger.error("Unexpected error [token:%s]: %s", token_hash, error_type)
         raise HTTPException(status_code=500, detail="An unexpected error occurred. Please try again.")
 
 
+class BodySizeLimitMiddleware:
+    """Plain ASGI middleware rejecting oversized /generate-image bodies before parsing
+
+    A declared Content-Length over the limit is answered with 413 right away;
+    chunked bodies are counted as they are received and cut off the same way.
+    """
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != "/generate-image":
+            await self.app(scope, receive, send)
+            return
+        
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > self.max_bytes:
+                response = ORJSONResponse(status_code=413, content={"detail": "Request body too large."})
+                await response(scope, receive, send)
+                return
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Surfaces from FastAPI's body parsing as a 413 response
+                    raise HTTPException(status_code=413, detail="Request body too large.")
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_BODY_BYTES)
+
 @app.middleware("http")
 async def add_security_headers(request: Request, call_next):
     response = await call_next(request)